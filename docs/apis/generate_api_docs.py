@@ -13,9 +13,20 @@
 #
 
 import os
+import re
+import shutil
 import sys
 import subprocess
+import tempfile
 import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+BODY_RE = re.compile(rb"</body>")
+
+# Script elements to inject into JavaDoc html files, keyed by slash count of the file path
+_snippet_cache = {}
 
 
 def main():
@@ -92,11 +103,16 @@ def main():
         (kernel_javadoc_gen_dir, kernel_javadoc_final_dir),
     ]
 
-    run_cmd(["rm", "-rf", all_docs_final_dir])
-    run_cmd(["mkdir", "-p", all_docs_final_dir])
-    for (src_dir, dst_dir) in src_dst_dirs:
-        run_cmd(["mkdir", "-p", dst_dir])
-        run_cmd(["cp", "-r", src_dir.rstrip("/") + "/", dst_dir])
+    shutil.rmtree(all_docs_final_dir, ignore_errors=True)
+    os.makedirs(all_docs_final_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=len(src_dst_dirs)) as executor:
+        copies = [
+            executor.submit(
+                shutil.copytree, src_dir, dst_dir, copy_function=shutil.copy, dirs_exist_ok=True)
+            for (src_dir, dst_dir) in src_dst_dirs
+        ]
+        for copy in copies:
+            copy.result()
 
     print("## API docs generated in " + all_docs_final_dir)
 
@@ -112,32 +128,13 @@ def patch_java_docs(javadoc_dir, docs_root_dir, jquery_path):
     print("### Patching JavaDoc in %s ..." % javadoc_dir)
     with WorkingDirectory(javadoc_dir):
         # Find html files to patch
-        (_, stdout, _) = run_cmd(["find", ".", "-name", "*.html", "-mindepth", "2"])
-        log("HTML files found:\n" + stdout)
-        javadoc_files = [line for line in stdout.split('\n') if line.strip() != '']
-
-        js_script_start = '<script defer="defer" type="text/javascript" src="'
-        js_script_end = '"></script>'
+        javadoc_files = [p for p in Path(".").rglob("*.html") if len(p.parts) >= 2]
+        log("%d HTML files found" % len(javadoc_files))
 
-        # Patch the html files
-        for javadoc_file in javadoc_files:
-            # Generate relative path to js files based on how deep the html file is
-            slash_count = javadoc_file.count("/")
-            i = 1
-            path_to_js_file = ""
-            while i < slash_count:
-                path_to_js_file = path_to_js_file + "../"
-                i += 1
-
-            # Create script elements to load new js files
-            javadoc_jquery_script = \
-                js_script_start + path_to_js_file + "lib/jquery.min.js" + js_script_end
-            javadoc_api_docs_script = \
-                js_script_start + path_to_js_file + "lib/api-javadocs.js" + js_script_end
-            javadoc_script_elements = javadoc_jquery_script + javadoc_api_docs_script
-
-            # Add script elements to body of the html file
-            replace(javadoc_file, "</body>", javadoc_script_elements + "</body>")
+        # Patch the html files. Each file is patched independently, so spread them over threads
+        # to overlap the disk I/O.
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            list(executor.map(patch_javadoc_file, javadoc_files))
 
         # Patch the js and css files
         run_cmd(["mkdir", "-p", "./lib"])
@@ -146,7 +143,33 @@ def patch_java_docs(javadoc_dir, docs_root_dir, jquery_path):
         append(docs_root_dir + "/apis/api-javadocs.css", "./stylesheet.css")  # append new styles
 
 
-def run_cmd(cmd, throw_on_error=True, env=None, stream_output=False, **kwargs):
+def patch_javadoc_file(javadoc_file):
+    # Add script elements to body of the html file. The number of path parts of "a/b.html" is
+    # the number of slashes in "./a/b.html".
+    javadoc_script_elements = javadoc_script_elements_for(len(javadoc_file.parts))
+    replace(javadoc_file, BODY_RE, javadoc_script_elements + "</body>")
+
+
+def javadoc_script_elements_for(slash_count):
+    """Returns the script elements loading the new js files for an html file at the given depth.
+
+    The elements are built once per depth and cached, as many files share the same depth.
+    """
+    if slash_count not in _snippet_cache:
+        # Generate relative path to js files based on how deep the html file is
+        path_to_js_file = "../" * max(0, slash_count - 1)
+
+        js_script_start = '<script defer="defer" type="text/javascript" src="'
+        js_script_end = '"></script>'
+        javadoc_jquery_script = \
+            js_script_start + path_to_js_file + "lib/jquery.min.js" + js_script_end
+        javadoc_api_docs_script = \
+            js_script_start + path_to_js_file + "lib/api-javadocs.js" + js_script_end
+        _snippet_cache[slash_count] = javadoc_jquery_script + javadoc_api_docs_script
+    return _snippet_cache[slash_count]
+
+
+def run_cmd(cmd, throw_on_error=True, env=None, stream_output=False, capture=False, **kwargs):
     """Runs a command as a child process.
 
     A convenience wrapper for running a command from a Python script.
@@ -154,11 +177,13 @@ def run_cmd(cmd, throw_on_error=True, env=None, stream_output=False, **kwargs):
     cmd -- the command to run, as a list of strings
     throw_on_error -- if true, raises an Exception if the exit code of the program is nonzero
     env -- additional environment variables to be defined when running the child process
-    stream_output -- if true, does not capture standard output and error; if false, captures these
-      streams and returns them
+    stream_output -- if true, does not capture standard output and error
+    capture -- only used if stream_output is false; if true, captures standard output and error
+      and returns them; if false, spools both to a temporary file that is only read back to be
+      included in the exception raised on a nonzero exit code
 
-    Note on the return value: If stream_output is true, then only the exit code is returned. If
-    stream_output is false, then a tuple of the exit code, standard output and standard error is
+    Note on the return value: If stream_output is true or capture is false, then only the exit
+    code is returned. Otherwise, a tuple of the exit code, standard output and standard error is
     returned.
     """
     log("Running command %s" % str(cmd))
@@ -172,6 +197,22 @@ def run_cmd(cmd, throw_on_error=True, env=None, stream_output=False, **kwargs):
         if throw_on_error and exit_code != 0:
             raise Exception("Non-zero exitcode: %s" % exit_code)
         return exit_code
+    elif not capture:
+        # Spool the output to disk rather than memory, and only read it back to report a failure
+        with tempfile.TemporaryFile() as output:
+            child = subprocess.Popen(
+                cmd,
+                env=cmd_env,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+                **kwargs)
+            exit_code = child.wait()
+            if throw_on_error and exit_code != 0:
+                output.seek(0)
+                raise Exception(
+                    "Non-zero exitcode: %s\n\nOUTPUT:\n%s" %
+                    (exit_code, output.read().decode("UTF-8", errors="replace")))
+        return exit_code
     else:
         child = subprocess.Popen(
             cmd,
@@ -192,25 +233,42 @@ def run_cmd(cmd, throw_on_error=True, env=None, stream_output=False, **kwargs):
         return (exit_code, stdout, stderr)
 
 
+@functools.lru_cache(maxsize=None)
+def _load(src):
+    return Path(src).read_bytes()
+
+
 def append(src, dst):
     log("Appending %s to %s" % (src, dst))
-    fin = open(src, "r")
-    str = fin.read()
-    fin.close()
-    fout = open(dst, "a")
-    fout.write(str)
-    fout.close()
+    with Path(dst).open("ab") as fout:
+        fout.write(_load(src))
 
 
 def replace(file, pattern, replacement):
-    log("Replacing %s with %s in file %s" % (pattern, replacement, file))
-    fin = open(file, "r")
-    str = fin.read()
-    fin.close()
-    str = str.replace(pattern, replacement)
-    fout = open(file, "w")
-    fout.write(str)
-    fout.close()
+    """Replaces the first match of the precompiled bytes regex pattern in the given file.
+
+    The file is left untouched if the pattern is not present, and is otherwise replaced
+    atomically.
+    """
+    log("Replacing %s with %s in file %s" % (pattern.pattern.decode("UTF-8"), replacement, file))
+    replacement_bytes = replacement.encode("UTF-8")
+    data = Path(file).read_bytes()
+    (new_data, num_replaced) = pattern.subn(lambda _: replacement_bytes, data, count=1)
+    if num_replaced == 0:
+        return
+
+    # Write to a temp file next to the original and rename it over, so each file is swapped
+    # atomically with a single metadata update.
+    tmp = tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(file) or ".", delete=False)
+    try:
+        with tmp:
+            tmp.write(new_data)
+        shutil.copymode(file, tmp.name)
+        os.replace(tmp.name, file)
+    except BaseException:
+        # Do not leave the temp file behind in the doc tree
+        os.unlink(tmp.name)
+        raise
 
 
 # pylint: disable=too-few-public-methods
@@ -15,11 +15,13 @@
 #
 
 import os
+import shutil
 import sys
-import threading
+import tempfile
 
 from pyspark.sql import SparkSession
-from multiprocessing.pool import ThreadPool
+from pyspark.sql.types import StructType, StructField, IntegerType
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 
 """
@@ -129,43 +131,59 @@ spark = SparkSession \
 
 # spark.sparkContext.setLogLevel("INFO")
 
-data = spark.createDataFrame([], "id: int, a: int")
+# Built once and reused by every transaction so that no schema gets parsed per write.
+SCHEMA = StructType([StructField("id", IntegerType()), StructField("a", IntegerType())])
+
+data = spark.createDataFrame([], schema=SCHEMA)
 print("writing:", data.collect())
 data.write.format("delta").mode("overwrite").partitionBy("id").save(delta_table_path)
 
 
 def write_tx(n):
-    data = spark.createDataFrame([[n, n]], "id: int, a: int")
-    print("writing:", data.collect())
+    rows = [(n, n)]
+    data = spark.createDataFrame(rows, schema=SCHEMA)
+    print("writing:", rows)
     data.write.format("delta").mode("append").partitionBy("id").save(delta_table_path)
 
 
-stop_reading = threading.Event()
-
+def print_row_count(batch_df, batch_id):
+    row = batch_df.first()
+    print("Reading {:d} rows ...".format(row[0] if row else 0))
 
-def read_data():
-    while not stop_reading.is_set():
-        print("Reading {:d} rows ...".format(
-            spark.read.format("delta").load(delta_table_path).distinct().count())
-        )
-        time.sleep(1)
 
-
-def start_read_thread():
-    thread = threading.Thread(target=read_data)
-    thread.start()
-    return thread
+def start_read_stream(checkpoint_dir):
+    # Streams the table instead of re-reading it every second, so each trigger only processes the
+    # commits made since the previous one.
+    return spark.readStream.format("delta").load(delta_table_path) \
+        .groupBy().count() \
+        .writeStream \
+        .outputMode("complete") \
+        .option("checkpointLocation", checkpoint_dir) \
+        .trigger(processingTime="1 second") \
+        .foreachBatch(print_row_count) \
+        .start()
 
 
 print("===================== Starting reads and writes =====================")
-read_threads = [start_read_thread() for i in range(concurrent_readers)]
-pool = ThreadPool(concurrent_writers)
+read_checkpoint_dirs = [tempfile.mkdtemp(prefix="delta-ddb-read-")
+                        for i in range(concurrent_readers)]
+read_streams = [start_read_stream(checkpoint_dir) for checkpoint_dir in read_checkpoint_dirs]
 start_t = time.time()
-pool.map(write_tx, range(num_rows))
-stop_reading.set()
-
-for thread in read_threads:
-    thread.join()
+try:
+    with ThreadPoolExecutor(max_workers=concurrent_writers) as executor:
+        write_futures = [executor.submit(write_tx, n) for n in range(num_rows)]
+        for future in as_completed(write_futures):
+            future.result()
+finally:
+    for stream in read_streams:
+        stream.stop()
+    for checkpoint_dir in read_checkpoint_dirs:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    # stop() does not surface failures, so fail the test if any reader broke along the way
+    for stream in read_streams:
+        if stream.exception() is not None:
+            raise stream.exception()
 
 print("===================== Evaluating number of written rows =====================")
 actual = spark.read.format("delta").load(delta_table_path).distinct().count()
@@ -178,15 +196,26 @@ print(f"{num_rows / t:.02f} tx / sec")
 
 print("===================== Evaluating DDB writes =====================")
 import boto3
+from boto3.dynamodb.conditions import Key
 from botocore.config import Config
 my_config = Config(
     region_name=dynamo_region,
 )
 dynamodb = boto3.resource('dynamodb',  config=my_config)
 table = dynamodb.Table(dynamo_table_name)  # this ensures we actually used/created the input table
-response = table.scan()
-items = response['Items']
-items = sorted(items, key=lambda x: x['fileName'])
+# Only query this run's table path (the HASH key) instead of scanning everything the DDB table
+# has accumulated. Items come back sorted by fileName (the RANGE key).
+query_kwargs = {
+    "KeyConditionExpression": Key('tablePath').eq(delta_table_path),
+    "ConsistentRead": True,
+}
+items = []
+while True:
+    response = table.query(**query_kwargs)
+    items.extend(response['Items'])
+    if 'LastEvaluatedKey' not in response:
+        break
+    query_kwargs["ExclusiveStartKey"] = response['LastEvaluatedKey']
 
 print("========== All DDB items ==========")
 for item in items: